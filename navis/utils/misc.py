@@ -11,15 +11,16 @@
 #    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 #    GNU General Public License for more details.
 
-import inspect
-import requests
-import urllib
+import math
+import re
+import sys
 
 import numpy as np
 import pandas as pd
 
-from collections import defaultdict
-from functools import wraps
+from collections import defaultdict, deque
+from functools import wraps, lru_cache
+from itertools import chain
 from typing import Optional, Union, List, Iterable, Dict, Tuple, Any
 
 from .. import config, core, transforms
@@ -29,18 +30,60 @@ from .iterables import is_iterable, make_iterable
 # Set up logging
 logger = config.logger
 
+# Matches "scheme://netloc" at the start of a string
+_URL_RE = re.compile(r'^[A-Za-z][A-Za-z0-9+\-.]*://[^/?#]+')
+
+# Containers that unpack_neurons will descend into
+_SEQUENCE_TYPES = (list, np.ndarray, tuple)
+
+# (BaseNeuron, NeuronList) - can't be set at import time because navis.core
+# is only partially initialized when this module is first imported
+_NEURON_TYPES: Optional[tuple] = None
+
+
+def _neuron_types() -> tuple:
+    """Return tuple of neuron types for use with ``isinstance``."""
+    global _NEURON_TYPES
+    if _NEURON_TYPES is None:
+        _NEURON_TYPES = (core.BaseNeuron, core.NeuronList)
+    return _NEURON_TYPES
+
+
+_SIZE_UNITS = ('', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi', 'Yi')
+
 
 def sizeof_fmt(num, suffix='B'):
-    """Bytes to Human readable."""
-    for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
-        if abs(num) < 1024.0:
-            return "%3.1f%s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f%s%s" % (num, 'Yi', suffix)
+    """Bytes to Human readable.
+
+    Examples
+    --------
+    >>> from navis.utils import sizeof_fmt
+    >>> sizeof_fmt(1023)
+    '1023.0B'
+    >>> sizeof_fmt(1024 ** 2)
+    '1.0MiB'
+    >>> sizeof_fmt(1024 ** 9)
+    '1024.0YiB'
+    >>> sizeof_fmt(float('inf'))
+    'infB'
+
+    """
+    # Can't work out a unit for inf/nan (math.isfinite, unlike np.isfinite,
+    # also works for arbitrarily large Python ints)
+    if not math.isfinite(num):
+        return "%3.1f%s" % (num, suffix)
+
+    # Every 10 bits is one unit step (1024 = 2 ** 10)
+    ix = min(max((int(abs(num)).bit_length() - 1) // 10, 0),
+             len(_SIZE_UNITS) - 1)
+    return "%3.1f%s%s" % (num / (1 << (10 * ix)), _SIZE_UNITS[ix], suffix)
 
 
 def make_volume(x: Any) -> 'core.Volume':
     """Try making a navis.Volume from input object."""
+    # Exact type check is cheaper than isinstance for the common case
+    if type(x) is core.Volume:
+        return x
     if isinstance(x, core.Volume):
         return x
     if is_mesh(x):
@@ -56,7 +99,8 @@ def make_volume(x: Any) -> 'core.Volume':
 def map_neuronlist(desc: str = "",
                    can_zip: List[Union[str, int]] = [],
                    must_zip: List[Union[str, int]] = [],
-                   progress: bool = True):
+                   progress: bool = True,
+                   batchable: bool = False):
     """Run function on all neurons in the NeuronList.
 
     Parameters
@@ -91,6 +135,17 @@ def map_neuronlist(desc: str = "",
     progress :      bool
                     Whether to show a progress bar or not. Overrruled by
                     ``config.pbar_hide``.
+    batchable :     bool
+                    If True, the decorated function must also accept a
+                    (N, 3) array of coordinates and return an array of the
+                    same shape. For lists of TreeNeurons (and absent any
+                    zipped arguments) the function is then called once on the
+                    combined node and connector coordinates of all neurons
+                    and the results are mapped back onto the neurons. For
+                    consistent results, applying the function to a single
+                    neuron must have the same effect as applying it to that
+                    neuron's node and connector coordinates. Note that
+                    ``desc`` and ``progress`` are ignored in batch mode.
 
     To-implement
     ------------
@@ -105,7 +160,18 @@ def map_neuronlist(desc: str = "",
     #   it work with integers instead of strings
     # - in theory, we could also implement parallel processing here
 
+    # Intern parameter names to speed up the kwargs lookups in the wrapper
+    can_zip = [sys.intern(p) if isinstance(p, str) else p for p in can_zip]
+    must_zip = [sys.intern(p) if isinstance(p, str) else p for p in must_zip]
+
     def decorator(function):
+        # See if function has an inplace parameter - we only need to do this
+        # once at decoration time
+        import inspect
+        sig = inspect.signature(function)
+        has_inplace = 'inplace' in sig.parameters
+        inplace_default = sig.parameters['inplace'].default if has_inplace else None
+
         @wraps(function)
         def wrapper(*args, **kwargs):
             nl = None
@@ -123,7 +189,7 @@ def map_neuronlist(desc: str = "",
                         nl_key = key
                         break
 
-            if isinstance(nl, type(None)):
+            if nl is None:
                 raise ValueError('Unable to identify the neurons for call'
                                  f'{function}:\n {args}\n {kwargs}')
 
@@ -136,22 +202,31 @@ def map_neuronlist(desc: str = "",
                 else:
                     _ = kwargs.pop(nl_key)
 
-                # See if function has inplace parameter
-                sig = inspect.signature(function)
-                has_inplace = 'inplace' in sig.parameters
                 # If function has an inplace parameter
+                copy_neurons = False
                 if has_inplace:
                     # See if user has specified inplace, if not use the default
-                    inplace = kwargs.pop('inplace', sig.parameters['inplace'].default)
-                    # If not inplace make a copy (which will be returned)
-                    if not inplace:
-                        nl = nl.copy()
-
-                # Parse "can zip" arguments
-                can_zip_kwargs = [{} for n in nl]
+                    inplace = kwargs.pop('inplace', inplace_default)
+                    # If not inplace, each neuron is copied right before it is
+                    # processed and a NeuronList of the copies is returned.
+                    # This avoids a separate pass over the list just to copy.
+                    copy_neurons = not inplace
+
+                # Fast path for single neurons: nothing to zip and no need for
+                # a progress bar
+                if len(nl) == 1 and not (can_zip or must_zip):
+                    if has_inplace:
+                        kwargs['inplace'] = True
+                    n = nl[0].copy() if copy_neurons else nl[0]
+                    _ = function(n, *args, **kwargs)
+                    return nl.__class__([n], make_copy=False) if copy_neurons else nl
+
+                # Parse "can zip" and "must zip" arguments into one list of
+                # values per parameter
+                zip_kwargs = {}
                 for p in can_zip:
                     # Skip if not present or is None
-                    if p not in kwargs or isinstance(kwargs[p], type(None)):
+                    if p not in kwargs or kwargs[p] is None:
                         continue
 
                     if is_iterable(kwargs[p]):
@@ -162,43 +237,90 @@ def map_neuronlist(desc: str = "",
                                              f'{len(nl)} neurons.')
 
                         # Zip
-                        for i, v in enumerate(kwargs.pop(p)):
-                            can_zip_kwargs[i][p] = v
+                        zip_kwargs[p] = list(kwargs.pop(p))
 
-                # Parse "must zip" arguments
-                must_zip_kwargs = [{} for n in nl]
                 for p in must_zip:
                     # Skip if not present or is None
-                    if p not in kwargs or isinstance(kwargs[p], type(None)):
+                    if p not in kwargs or kwargs[p] is None:
                         continue
 
-                    values = make_iterable(kwargs.pop(p))
+                    values = kwargs.pop(p)
+                    # Only coerce if not already a sequence we can index into
+                    if not isinstance(values, (list, tuple, np.ndarray)):
+                        values = make_iterable(values)
                     if len(values) != len(nl):
                         raise ValueError(f'Got {len(values)} values of `{p}` for '
                                          f'{len(nl)} neurons.')
 
                     # Zip
-                    for i, v in enumerate(values):
-                        must_zip_kwargs[i][p] = v
+                    zip_kwargs[p] = values
 
                 # Whether we want to hide the progress bar
                 hide = config.pbar_hide or not progress or len(nl) == 1
 
+                # In batch mode run the function once on the node coordinates of
+                # all neurons combined instead of once per neuron
+                if (batchable and not zip_kwargs and len(nl) > 1
+                        and all(isinstance(n, core.TreeNeuron) for n in nl)):
+                    neurons = [n.copy() for n in nl] if copy_neurons else nl.neurons
+
+                    # Collect node and connector coordinates
+                    xyz = []
+                    for n in neurons:
+                        xyz.append(n.nodes[['x', 'y', 'z']].to_numpy())
+                        if n.has_connectors:
+                            xyz.append(n.connectors[['x', 'y', 'z']].to_numpy())
+                    offsets = np.cumsum([0] + [len(co) for co in xyz])
+                    xyz = np.concatenate(xyz)
+
+                    xyz_xf = function(xyz, *args, **kwargs)
+
+                    # Make sure we got one xyz coordinate per input coordinate
+                    # before we start changing any neurons
+                    if getattr(xyz_xf, 'shape', None) != xyz.shape:
+                        raise ValueError(f'Expected {function.__name__} to '
+                                         f'return coordinates of shape '
+                                         f'{xyz.shape}, got '
+                                         f'{getattr(xyz_xf, "shape", type(xyz_xf))}')
+
+                    # Map results back
+                    xyz_xf = iter(np.split(xyz_xf, offsets[1:-1]))
+                    for n in neurons:
+                        n.nodes.loc[:, ['x', 'y', 'z']] = next(xyz_xf)
+                        if n.has_connectors:
+                            n.connectors.loc[:, ['x', 'y', 'z']] = next(xyz_xf)
+                        # Coordinates changed -> e.g. cable length is stale
+                        n._clear_temp_attr()
+
+                    return nl.__class__(neurons, make_copy=False) if copy_neurons else nl
+
                 # Whether we need to/can specify inplace=True
                 if has_inplace:
                     kwargs['inplace'] = True
 
                 # Now run the function for each neuron
-                for i, n in config.tqdm(enumerate(nl),
-                                        desc=desc,
-                                        disable=hide,
-                                        total=len(nl),
-                                        leave=config.pbar_leave):
-
-                    _ = function(n, *args, **kwargs,
-                                 **can_zip_kwargs[i], **must_zip_kwargs[i])
-
-                return nl
+                pbar = config.tqdm(nl,
+                                   desc=desc,
+                                   disable=hide,
+                                   total=len(nl),
+                                   leave=config.pbar_leave)
+                copies = []
+                if not zip_kwargs:
+                    # Nothing to zip -> no per-neuron kwargs needed
+                    for n in pbar:
+                        if copy_neurons:
+                            n = n.copy()
+                            copies.append(n)
+                        _ = function(n, *args, **kwargs)
+                else:
+                    for i, n in enumerate(pbar):
+                        if copy_neurons:
+                            n = n.copy()
+                            copies.append(n)
+                        _ = function(n, *args, **kwargs,
+                                     **{k: v[i] for k, v in zip_kwargs.items()})
+
+                return nl.__class__(copies, make_copy=False) if copy_neurons else nl
             else:
                 # If single neuron just pass through
                 return function(*args, **kwargs)
@@ -242,27 +364,38 @@ def is_url(x: str) -> bool:
     False
     >>> is_url('http://www.google.com')
     True
+    >>> is_url(' http://www.google.com')
+    True
+    >>> is_url(b'http://www.google.com')
+    True
 
     """
-    parsed = urllib.parse.urlparse(x)
-
-    if parsed.netloc and parsed.scheme:
-        return True
-    else:
-        return False
+    # urlparse (which this used to use) accepts bytes and ignores surrounding
+    # whitespace - keep it that way
+    if isinstance(x, (bytes, bytearray)):
+        x = x.decode('utf-8', errors='replace')
+    return _URL_RE.match(x.strip()) is not None
 
 
+@lru_cache(maxsize=1)
 def _type_of_script() -> str:
     """Return context (terminal, jupyter, iPython) in which navis is run."""
-    try:
-        ipy_str = str(type(get_ipython()))  # type: ignore
-        if 'zmqshell' in ipy_str:
-            return 'jupyter'
-        else:  # if 'terminal' in ipy_str:
-            return 'ipython'
-    except BaseException:
+    # If IPython hasn't been imported, we can't be running in it - and there
+    # is no point importing it just to find out
+    if 'IPython' not in sys.modules:
         return 'terminal'
 
+    from IPython import get_ipython  # type: ignore
+
+    ipy = get_ipython()
+    if ipy is None:
+        return 'terminal'
+
+    if 'zmqshell' in str(type(ipy)):
+        return 'jupyter'
+    else:
+        return 'ipython'
+
 
 def is_jupyter() -> bool:
     """Test if navis is run in a Jupyter notebook.
@@ -372,15 +505,24 @@ def unpack_neurons(x: Union[Iterable, 'core.NeuronList', 'core.NeuronObject'],
     """
     neurons: list = []
 
-    if isinstance(x, (list, np.ndarray, tuple)):
-        for l in x:
-            neurons += unpack_neurons(l)
-    elif isinstance(x, core.BaseNeuron):
-        neurons.append(x)
-    elif isinstance(x, core.NeuronList):
-        neurons += x.neurons
-    elif raise_on_error:
-        raise TypeError(f'Unknown neuron format: "{type(x)}"')
+    # Walk nested iterables depth-first using an explicit stack instead of
+    # recursion. Items are pushed in reverse to preserve the original order.
+    stack = deque([x])
+    while stack:
+        cur = stack.pop()
+        # Dispatch on exact container types first - identity checks are much
+        # cheaper than isinstance; subclasses are caught further down
+        t = type(cur)
+        if t is list or t is tuple or t is np.ndarray:
+            stack.extend(reversed(cur))
+        elif isinstance(cur, core.BaseNeuron):
+            neurons.append(cur)
+        elif isinstance(cur, _SEQUENCE_TYPES):
+            stack.extend(reversed(cur))
+        elif isinstance(cur, core.NeuronList):
+            neurons.extend(cur.neurons)
+        elif raise_on_error:
+            raise TypeError(f'Unknown neuron format: "{type(cur)}"')
 
     return neurons
 
@@ -442,6 +584,10 @@ def parse_objects(x) -> Tuple['core.NeuronList',
     <class 'numpy.ndarray'>
     >>> type(vis), len(points)
     (<class 'list'>, 1)
+    >>> # Arrays that aren't 2-D are dropped
+    >>> _, _, points, _ = parse_objects([np.zeros(5), p, np.zeros(7)])
+    >>> len(points), points[0] is p
+    (1, True)
 
     """
     # Make sure this is a list.
@@ -449,46 +595,57 @@ def parse_objects(x) -> Tuple['core.NeuronList',
         x = [x]
 
     # If any list in x, flatten first
-    if any([isinstance(i, list) for i in x]):
+    if any(isinstance(i, list) for i in x):
         # We need to be careful to preserve order because of colors
-        y = []
-        for i in x:
-            y += i if isinstance(i, list) else [i]
-        x = y
-
-    # Collect neuron objects, make a single NeuronList and split into types
-    neurons = core.NeuronList([ob for ob in x if isinstance(ob,
-                                                            (core.BaseNeuron,
-                                                             core.NeuronList))],
-                              make_copy=False)
-
-    # Collect visuals
-    visuals = [ob for ob in x if 'vispy' in str(type(ob))]
-
-    # Collect and parse volumes
-    volumes = [ob for ob in x if not isinstance(ob, (core.BaseNeuron,
-                                                     core.NeuronList))
-                                 and is_mesh(ob)]
-    # Add templatebrains
-    volumes += [ob.mesh for ob in x if isinstance(ob, transforms.templates.TemplateBrain)]
+        x = list(chain.from_iterable(i if isinstance(i, list) else (i, ) for i in x))
+
+    # Sort objects into their respective categories in a single pass
+    neuron_obs = []
+    visuals = []
+    volumes = []
+    templates = []
+    dataframes = []
+    arrays = []
+    neuron_types = _neuron_types()
+    for ob in x:
+        if isinstance(ob, neuron_types):
+            neuron_obs.append(ob)
+        elif 'vispy' in type(ob).__module__:
+            visuals.append(ob)
+        elif isinstance(ob, transforms.templates.TemplateBrain):
+            templates.append(ob.mesh)
+        elif isinstance(ob, pd.DataFrame):
+            dataframes.append(ob)
+        elif isinstance(ob, np.ndarray):
+            # No need to copy: points are only ever read downstream
+            arrays.append(ob)
+        elif is_mesh(ob):
+            volumes.append(ob)
+
+    # Make a single NeuronList
+    neurons = core.NeuronList(neuron_obs, make_copy=False)
+
+    # Add templatebrains after the other volumes
+    volumes += templates
     # Converts any non-navis meshes into Volumes
     volumes = [core.Volume(v) if not isinstance(v, core.Volume) else v for v in volumes]
 
-    # Collect dataframes with X/Y/Z coordinates
-    dataframes = [ob for ob in x if isinstance(ob, pd.DataFrame)]
-    if [d for d in dataframes if False in np.isin(['x', 'y', 'z'], d.columns)]:
+    # Check dataframes for X/Y/Z coordinates
+    if [d for d in dataframes if not {'x', 'y', 'z'}.issubset(d.columns)]:
         logger.warning('DataFrames must have x, y and z columns.')
     # Filter to and extract x/y/z coordinates
-    dataframes = [d for d in dataframes if False not in [c in d.columns for c in ['x', 'y', 'z']]]
-    dataframes = [d[['x', 'y', 'z']].values for d in dataframes]
-
-    # Collect arrays
-    arrays = [ob.copy() for ob in x if isinstance(ob, np.ndarray)]
-    # Remove arrays with wrong dimensions
-    if [ob for ob in arrays if ob.shape[1] != 3 and ob.shape[0] != 2]:
+    dataframes = [d for d in dataframes if {'x', 'y', 'z'}.issubset(d.columns)]
+    dataframes = [d[['x', 'y', 'z']].to_numpy() for d in dataframes]
+
+    # Remove arrays with wrong dimensions - check all shapes in one go. Arrays
+    # that aren't 2-D get a dummy (0, 0) shape so that they are dropped
+    shapes = np.array([ob.shape if ob.ndim == 2 else (0, 0) for ob in arrays],
+                      dtype=np.int64).reshape(-1, 2)
+    if np.any((shapes[:, 1] != 3) & (shapes[:, 0] != 2)):
         logger.warning('Arrays need to be of shape (N, 3) for scatter or (2, N)'
                        ' for line plots.')
-    arrays = [ob for ob in arrays if any(np.isin(ob.shape, [2, 3]))]
+    keep = np.isin(shapes, [2, 3]).any(axis=1)
+    arrays = [ob for ob, k in zip(arrays, keep) if k]
 
     points = dataframes + arrays
 
@@ -529,13 +686,18 @@ def make_url(baseurl, *args: str, **GET) -> str:
     True
 
     """
-    url = baseurl
-    # Generate the URL
+    # Generate the URL - arguments are always path components, so there is no
+    # need to (re-)parse the URL via urljoin for each of them
+    parts = [baseurl]
     for arg in args:
         arg_str = str(arg)
-        joiner = '' if url.endswith('/') else '/'
+        if not parts[-1].endswith('/'):
+            parts.append('/')
         relative = arg_str[1:] if arg_str.startswith('/') else arg_str
-        url = requests.compat.urljoin(url + joiner, relative)
+        if relative:
+            parts.append(relative)
+    url = ''.join(parts)
     if GET:
-        url += f'?{urllib.parse.urlencode(GET)}'
+        from urllib.parse import urlencode
+        url += f'?{urlencode(GET)}'
     return url
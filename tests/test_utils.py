@@ -0,0 +1,152 @@
+import navis
+import numpy as np
+import pytest
+
+from navis.utils import map_neuronlist
+
+
+@map_neuronlist(desc='Shifting')
+def _shift(x, *, offset=1, inplace=False):
+    if not inplace:
+        x = x.copy()
+    x.nodes['x'] += offset
+    return x
+
+
+@map_neuronlist(desc='Shifting', can_zip=['offset'], must_zip=['name'])
+def _shift_zip(x, *, offset=1, name=None, inplace=False):
+    if not inplace:
+        x = x.copy()
+    x.nodes['x'] += offset
+    if name is not None:
+        x.name = name
+    return x
+
+
+def test_map_neuronlist_copy():
+    nl = navis.example_neurons(2)
+    orig = [n.nodes.x.values.copy() for n in nl]
+
+    res = _shift(nl, offset=10)
+    assert isinstance(res, navis.NeuronList)
+    assert res is not nl
+    for n, r, o in zip(nl, res, orig):
+        assert r is not n
+        assert np.allclose(n.nodes.x.values, o)
+        assert np.allclose(r.nodes.x.values, o + 10)
+
+
+def test_map_neuronlist_inplace():
+    nl = navis.example_neurons(2)
+    orig = [n.nodes.x.values.copy() for n in nl]
+
+    res = _shift(nl, offset=10, inplace=True)
+    assert res is nl
+    for n, o in zip(nl, orig):
+        assert np.allclose(n.nodes.x.values, o + 10)
+
+
+@pytest.mark.parametrize("inplace", [True, False])
+def test_map_neuronlist_single(monkeypatch, inplace):
+    nl = navis.NeuronList(navis.example_neurons(1))
+    orig = nl[0].nodes.x.values.copy()
+
+    # The single-neuron fast path must not touch the progress bar
+    def no_pbar(*args, **kwargs):
+        raise AssertionError('Fast path not taken')
+    monkeypatch.setattr(navis.config, 'tqdm', no_pbar)
+
+    res = _shift(nl, offset=10, inplace=inplace)
+    assert isinstance(res, navis.NeuronList) and len(res) == 1
+    assert np.allclose(res[0].nodes.x.values, orig + 10)
+    assert (res is nl) == inplace
+    if not inplace:
+        assert np.allclose(nl[0].nodes.x.values, orig)
+
+
+def test_map_neuronlist_zip():
+    nl = navis.example_neurons(3)
+    orig = [n.nodes.x.values.copy() for n in nl]
+
+    res = _shift_zip(nl, offset=[1, 2, 3], name=['a', 'b', 'c'])
+    for r, o, off, name in zip(res, orig, [1, 2, 3], ['a', 'b', 'c']):
+        assert np.allclose(r.nodes.x.values, o + off)
+        assert r.name == name
+
+    # Single `can_zip` values are re-used for all neurons
+    res = _shift_zip(nl, offset=5)
+    for r, o in zip(res, orig):
+        assert np.allclose(r.nodes.x.values, o + 5)
+
+
+def test_map_neuronlist_zip_mismatch():
+    nl = navis.example_neurons(3)
+
+    with pytest.raises(ValueError):
+        _shift_zip(nl, offset=[1, 2])
+
+    with pytest.raises(ValueError):
+        _shift_zip(nl, name=['a', 'b'])
+
+
+def _scale_xyz(xyz, factor):
+    return xyz * factor
+
+
+@map_neuronlist(desc='Scaling')
+def _scale(x, *, factor=2, inplace=False):
+    if isinstance(x, np.ndarray):
+        return _scale_xyz(x, factor)
+    if not inplace:
+        x = x.copy()
+    xyz = x.nodes[['x', 'y', 'z']].values
+    x.nodes.loc[:, ['x', 'y', 'z']] = _scale_xyz(xyz, factor)
+    if x.has_connectors:
+        xyz = x.connectors[['x', 'y', 'z']].values
+        x.connectors.loc[:, ['x', 'y', 'z']] = _scale_xyz(xyz, factor)
+    x._clear_temp_attr()
+    return x
+
+
+_scale_batch = map_neuronlist(desc='Scaling',
+                              batchable=True)(_scale.__wrapped__)
+
+
+@pytest.mark.parametrize("inplace", [True, False])
+def test_map_neuronlist_batchable(inplace):
+    nl1 = navis.example_neurons(3)
+    nl2 = navis.example_neurons(3)
+    assert all(n.has_connectors for n in nl2)
+
+    # Populate cached temporary attributes
+    cable = [n.cable_length for n in nl2]
+
+    res1 = _scale(nl1, factor=2, inplace=inplace)
+    res2 = _scale_batch(nl2, factor=2, inplace=inplace)
+    assert (res2 is nl2) == inplace
+
+    for n1, n2, c in zip(res1, res2, cable):
+        assert np.allclose(n1.nodes[['x', 'y', 'z']].values,
+                           n2.nodes[['x', 'y', 'z']].values)
+        assert np.allclose(n1.connectors[['x', 'y', 'z']].values,
+                           n2.connectors[['x', 'y', 'z']].values)
+        assert np.isclose(n2.cable_length, c * 2)
+
+
+@map_neuronlist(batchable=True)
+def _bad_batch(x, *, inplace=False):
+    if isinstance(x, np.ndarray):
+        return x[:-1]
+    return x
+
+
+def test_map_neuronlist_batchable_bad_shape():
+    nl = navis.example_neurons(2)
+    orig = [n.nodes[['x', 'y', 'z']].values.copy() for n in nl]
+
+    with pytest.raises(ValueError):
+        _bad_batch(nl, inplace=True)
+
+    # Neurons must not have been touched
+    for n, o in zip(nl, orig):
+        assert np.allclose(n.nodes[['x', 'y', 'z']].values, o)